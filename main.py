@@ -1,39 +1,48 @@
+import asyncio
 import logging
+import logging.handlers
+import queue
 import psycopg
+from psycopg_pool import AsyncConnectionPool
 import re
-import datetime
+import weakref
 import os
+import json
+import redis.asyncio as redis
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
 )
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-# Flask setup
-app = Flask('')
+# Keep-alive web server, served on the bot's event loop
+async def home(request):
+    return web.Response(text="Bot is alive!")
 
-@app.route('/')
-def home():
-    return "Bot is alive!"
+app = web.Application()
+app.router.add_get('/', home)
+web_runner = web.AppRunner(app)
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
-
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+async def keep_alive():
+    await web_runner.setup()
+    await web.TCPSite(web_runner, '0.0.0.0', PORT).start()
 
 # Bot credentials
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 SITE_LINK = os.getenv("SITE_LINK")
 AI_BOOST_LINK = os.getenv("AI_BOOST_LINK")  # For X package special content
+PUBLIC_URL = os.getenv("PUBLIC_URL")  # Enables webhook mode when set
+PORT = int(os.getenv("PORT", 8080))
 
 # Predefined payment accounts
 PAYMENT_ACCOUNTS = {
@@ -41,6 +50,9 @@ PAYMENT_ACCOUNTS = {
     "Nigeria (PALMPAY)": "🇳🇬 Account: 8995878610\nBank: PALMPAY\nName: Victor Anyanwu C.",
 }
 
+REG_ACCOUNT_PREFIX = "reg_account_"
+ACCOUNT_SELECTION_TEXT = "Select an account to pay to:\n\n:::Note:::\n If you are prompted by your Opay bank app to double check or cancel your transaction with any selected accoount amongst these, please ignore and continue as this is happening as a result of multiple engagement with the accounts\n Proceed with an option below:"
+
 # Help topics
 HELP_TOPICS = {
     "how_to_pay": {"label": "How to Pay", "type": "text", "text": "Payments can be made via bank transfer. Select an account from the options provided after choosing your package."},
@@ -52,72 +64,182 @@ HELP_TOPICS = {
     )},
 }
 
+# Keyboards
+BACK_TO_MENU_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]])
+BACK_TO_HELP_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Help Menu", callback_data="help")]])
+START_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(" What Is Mi'Amor?", callback_data="menu")],
+    [InlineKeyboardButton("🚀 How It Works", callback_data="menu")],
+    [InlineKeyboardButton("I want to get Started", callback_data="menu")],
+    [InlineKeyboardButton("❓ Help", callback_data="help")],
+])
+MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💸 I'm Interested", callback_data="package_selector")],
+    [InlineKeyboardButton("❓ Help", callback_data="help")],
+])
+REGISTERED_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📂 Access Content", callback_data="access_content")],
+    [InlineKeyboardButton("❓ Help", callback_data="help")],
+])
+HELP_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(topic["label"], callback_data=key)] for key, topic in HELP_TOPICS.items()]
+    + [[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]]
+)
+PACKAGE_SELECTOR_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🚀Miamor Ultra (₦14,000)", callback_data="reg_x")],
+    [InlineKeyboardButton("✈️Miamor Plus (₦10,000)", callback_data="reg_standard")],
+    [InlineKeyboardButton("🔙 Main Menu", callback_data="menu")],
+])
+PAYMENT_ACCOUNTS_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(a, callback_data=f"{REG_ACCOUNT_PREFIX}{a}")] for a in PAYMENT_ACCOUNTS]
+    + [[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]]
+)
+PAYMENT_DETAILS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Change Account", callback_data="show_account_selection")],
+    [InlineKeyboardButton("🔙 Main Menu", callback_data="menu")],
+])
+
 # Database setup with PostgreSQL
-try:
-    import urllib.parse as urlparse
-
-    url = os.getenv("DATABASE_URL")
-    result = urlparse.urlparse(url)
-    conn = psycopg.connect(
-        dbname=result.path[1:],
-        user=result.username,
-        password=result.password,
-        host=result.hostname,
-        port=result.port,
-        sslmode='require'
-    )
-    cursor = conn.cursor()
-
-    # Users table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        chat_id BIGINT PRIMARY KEY,
-        name TEXT,
-        username TEXT,
-        email TEXT,
-        phone TEXT,
-        package TEXT,
-        payment_status TEXT DEFAULT 'new',
-        approved_at TIMESTAMP,
-        registration_date TIMESTAMP
-    )
-    """)
-
-    # Payments table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS payments (
-        id SERIAL PRIMARY KEY,
-        chat_id BIGINT,
-        package TEXT,
-        payment_account TEXT,
-        status TEXT DEFAULT 'pending_payment',
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        approved_at TIMESTAMP
-    )
-    """)
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "1"))  # Server-side PREPARE after N executions
+
+class BinaryCursor(psycopg.AsyncCursor):
+    """Cursor that requests results in binary format, so BIGINT and TIMESTAMP
+    values skip text formatting and parsing on both ends."""
+
+    def __init__(self, connection, *, row_factory=None):
+        super().__init__(connection, row_factory=row_factory)
+        self.format = psycopg.pq.Format.BINARY
 
-    conn.commit()
-except psycopg.Error as e:
-    logging.error(f"Database error: {e}")
-    raise
+pool = AsyncConnectionPool(
+    DATABASE_URL,
+    min_size=2,
+    max_size=10,
+    open=False,
+    kwargs={
+        "sslmode": "require",
+        "prepare_threshold": DB_PREPARE_THRESHOLD,
+        "cursor_factory": BinaryCursor,
+    },
+)
+
+async def init_db():
+    try:
+        async with pool.connection() as aconn:
+            async with aconn.cursor() as cur:
+                # Users table
+                await cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id BIGINT PRIMARY KEY,
+                    name TEXT,
+                    username TEXT,
+                    email TEXT,
+                    phone TEXT,
+                    package TEXT,
+                    payment_status TEXT DEFAULT 'new',
+                    approved_at TIMESTAMP,
+                    registration_date TIMESTAMP
+                )
+                """)
+
+                # Payments table
+                await cur.execute("""
+                CREATE TABLE IF NOT EXISTS payments (
+                    id SERIAL PRIMARY KEY,
+                    chat_id BIGINT,
+                    package TEXT,
+                    payment_account TEXT,
+                    status TEXT DEFAULT 'pending_payment',
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    approved_at TIMESTAMP
+                )
+                """)
+
+                # Indexes for admin stats and payment approval lookups
+                await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_regdate
+                ON users (registration_date DESC) WHERE payment_status='registered'
+                """)
+                await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_package
+                ON users (package) WHERE payment_status='registered'
+                """)
+                await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_payments_chat_status
+                ON payments (chat_id, status)
+                """)
+    except psycopg.Error as e:
+        logging.error(f"Database error: {e}")
+        raise
+
+# User state storage
+class StateStore:
+    """Per-user conversation state, kept in Redis when REDIS_URL is set so
+    every worker sees the same state, otherwise in a bounded in-process cache."""
+
+    def __init__(self, redis_url=None, ttl=1800, maxsize=50_000):
+        self.ttl = ttl
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self.cache = None if self.redis else TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, uid):
+        if self.redis:
+            raw = await self.redis.get(f"user_state:{uid}")
+            return json.loads(raw) if raw else {}
+        return dict(self.cache.get(uid, {}))
+
+    async def set(self, uid, state):
+        if self.redis:
+            await self.redis.set(f"user_state:{uid}", json.dumps(state), ex=self.ttl)
+        else:
+            self.cache[uid] = state
+
+    async def pop(self, uid):
+        if self.redis:
+            await self.redis.delete(f"user_state:{uid}")
+        else:
+            self.cache.pop(uid, None)
 
-# In-memory storage
-user_state = {}
+    def expire(self):
+        if self.cache is not None:
+            self.cache.expire()
+
+    async def close(self):
+        if self.redis:
+            await self.redis.aclose()
+
+state_store = StateStore(os.getenv("REDIS_URL"))
 
 # Logging
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Records are queued on the event loop and written by a background thread
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_listener.start()
 logger = logging.getLogger(__name__)
 
 # Helper functions
-def get_status(chat_id):
+async def get_status(chat_id):
     try:
-        cursor.execute("SELECT payment_status FROM users WHERE chat_id=%s", (chat_id,))
-        row = cursor.fetchone()
+        async with pool.connection() as aconn:
+            async with aconn.cursor() as cur:
+                await cur.execute("SELECT payment_status FROM users WHERE chat_id=%s", (chat_id,))
+                row = await cur.fetchone()
         return row[0] if row else None
     except psycopg.Error as e:
         logger.error(f"Database error in get_status: {e}")
         return None
 
+async def record_payment(chat_id, package, account):
+    async with pool.connection() as aconn:
+        await aconn.execute(
+            "INSERT INTO payments (chat_id, package, payment_account) VALUES (%s, %s, %s)",
+            (chat_id, package, account)
+        )
+
 def log_interaction(chat_id, action):
     logger.info(f"Interaction: chat_id={chat_id}, action={action}")
 
@@ -126,26 +248,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     log_interaction(chat_id, "start")
     try:
-        cursor.execute("SELECT payment_status FROM users WHERE chat_id=%s", (chat_id,))
-        if not cursor.fetchone():
-            cursor.execute(
-                "INSERT INTO users (chat_id, username) VALUES (%s, %s)",
+        async with pool.connection() as aconn:
+            await aconn.execute(
+                "INSERT INTO users (chat_id, username) VALUES (%s, %s) ON CONFLICT (chat_id) DO NOTHING",
                 (chat_id, update.effective_user.username or "Unknown")
             )
-            conn.commit()
     except psycopg.Error as e:
         logger.error(f"Database error in start: {e}")
         await update.message.reply_text("An error occurred. Please try again.")
         return
-    keyboard = [
-    	[InlineKeyboardButton(" What Is Mi'Amor?", callback_data="menu")],
-    	[InlineKeyboardButton("🚀 How It Works", callback_data="menu")],
-    	[InlineKeyboardButton("I want to get Started", callback_data="menu")],
-    	[InlineKeyboardButton("❓ Help", callback_data="help")],
-    	]
     await update.message.reply_text(
         "Welcome to Mi’amor!\n\nGet paid for connecting, creating and having fun online.\n 💖Getting matched → earn $2.5 to $5 per match\n🔥Daily login streaks → earn $1.5 daily for simply logging in\n🧠Daily trivia & quizzes → earn $1–$5 depending on score\n🎮Game modules → earn up to $20 for every game played\n🏆Challenges → earn up to $100 for every weekly challenge\n👥Invite friends and more!\n\nChoose from the exclusive list of packages with the higher package unlockng the full Miamor experience\nClick the button below to:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=START_KB,
     )
 
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -155,19 +269,24 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     log_interaction(chat_id, "admin_stats")
     try:
-        cursor.execute("SELECT COUNT(*) FROM users WHERE payment_status='registered' AND package='Standard'")
-        standard_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE payment_status='registered' AND package='X'")
-        x_count = cursor.fetchone()[0]
+        async with pool.connection() as aconn:
+            async with aconn.cursor() as cur:
+                await cur.execute("""
+                SELECT COUNT(*) FILTER (WHERE package='Standard'),
+                       COUNT(*) FILTER (WHERE package='X')
+                FROM users
+                WHERE payment_status='registered'
+                """)
+                standard_count, x_count = await cur.fetchone()
+                await cur.execute("""
+                SELECT chat_id, package, registration_date 
+                FROM users 
+                WHERE payment_status='registered' 
+                ORDER BY registration_date DESC 
+                LIMIT 10
+                """)
+                last_users = await cur.fetchall()
         total = standard_count + x_count
-        cursor.execute("""
-        SELECT chat_id, package, registration_date 
-        FROM users 
-        WHERE payment_status='registered' 
-        ORDER BY registration_date DESC 
-        LIMIT 10
-        """)
-        last_users = cursor.fetchall()
         text = f"📊 Admin Stats:\n\n• Standard Users: {standard_count}\n• X Users: {x_count}\n• Total Registrations: {total}\n\nLast 10 Registrations:\n"
         for user in last_users:
             text += f"Chat ID: {user[0]}, Package: {user[1]}, Date: {user[2]}\n"
@@ -177,6 +296,131 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("An error occurred. Please try again.")
 
 # Callback handlers
+# Each receives the full callback data for exact matches, or the text after
+# the action prefix for "<action>_<argument>" callbacks (as an int for
+# CHAT_ID_ACTIONS).
+async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    await state_store.pop(update.callback_query.from_user.id)
+    await show_main_menu(update, context)
+
+async def package_selector_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    chat_id = update.callback_query.from_user.id
+    status = await get_status(chat_id)
+    if status == 'registered':
+        await context.bot.send_message(chat_id, "You are already registered.")
+        return
+    await update.callback_query.edit_message_text("Choose your package:", reply_markup=PACKAGE_SELECTOR_KB)
+
+async def register_package_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    query = update.callback_query
+    chat_id = query.from_user.id
+    package = "Standard" if data == "reg_standard" else "X"
+    await state_store.set(chat_id, {'package': package})
+    try:
+        async with pool.connection() as aconn:
+            await aconn.execute(
+                "INSERT INTO users (chat_id, package, payment_status, username) VALUES (%s, %s, 'pending_payment', %s) "
+                "ON CONFLICT (chat_id) DO UPDATE SET package=EXCLUDED.package, payment_status='pending_payment'",
+                (chat_id, package, update.effective_user.username or "Unknown")
+            )
+        await query.edit_message_text(ACCOUNT_SELECTION_TEXT, reply_markup=PAYMENT_ACCOUNTS_KB)
+    except psycopg.Error as e:
+        logger.error(f"Database error in package_selector: {e}")
+        await query.edit_message_text("An error occurred. Please try again.")
+
+async def reg_account_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, account: str):
+    chat_id = update.callback_query.from_user.id
+    payment_details = PAYMENT_ACCOUNTS.get(account)
+    if not payment_details:
+        await context.bot.send_message(chat_id, "Error: Invalid account. Contact admin.", reply_markup=BACK_TO_MENU_KB)
+        return
+    state = await state_store.get(chat_id)
+    if 'package' not in state:
+        await context.bot.send_message(chat_id, "Please select a package first.", reply_markup=BACK_TO_MENU_KB)
+        return
+    state['selected_account'] = account
+    state['expecting'] = 'reg_screenshot'
+    await state_store.set(chat_id, state)
+    await context.bot.send_message(
+        chat_id,
+        f"Payment details:\n\n{payment_details}\n\nPlease make the payment and send the screenshot.",
+        reply_markup=PAYMENT_DETAILS_KB
+    )
+
+async def show_account_selection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    query = update.callback_query
+    package = (await state_store.get(query.from_user.id)).get('package', '')
+    if not package:
+        await query.edit_message_text("Please select a package first.", reply_markup=BACK_TO_MENU_KB)
+        return
+    await query.edit_message_text(ACCOUNT_SELECTION_TEXT, reply_markup=PAYMENT_ACCOUNTS_KB)
+
+async def approve_reg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, user_chat_id: int):
+    query = update.callback_query
+    try:
+        async with pool.connection() as aconn:
+            async with aconn.pipeline():
+                await aconn.execute("UPDATE payments SET status='approved', approved_at=NOW() WHERE chat_id=%s AND status='pending_payment'", (user_chat_id,))
+                await aconn.execute("UPDATE users SET payment_status='pending_details', approved_at=NOW() WHERE chat_id=%s", (user_chat_id,))
+        await asyncio.gather(
+            context.bot.send_message(
+                user_chat_id,
+                "✅ Your payment is approved!\n\nPlease send your details:\n➡️ Email address\n➡️ Full name\n➡️ Username (e.g. @you)\n➡️ Phone number (with country code)\n\nAll in one message, each on its own line."
+            ),
+            query.edit_message_text("Payment approved. Waiting for user details."),
+        )
+    except psycopg.Error as e:
+        logger.error(f"Database error in approve_reg: {e}")
+        await query.edit_message_text("An error occurred. Please try again.")
+
+async def finalize_reg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, user_chat_id: int):
+    await state_store.set(ADMIN_ID, {'expecting': 'user_credentials', 'for_user': user_chat_id})
+    await context.bot.send_message(
+        ADMIN_ID,
+        f"Please send the username and password for user {user_chat_id} in the format:\nusername\npassword"
+    )
+    await update.callback_query.edit_message_text("Waiting for user credentials.")
+
+async def pending_reg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, user_chat_id: int):
+    await context.bot.send_message(user_chat_id, "Your payment is still being reviewed. Please check back later.")
+
+async def access_content_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    async with pool.connection() as aconn:
+        async with aconn.cursor() as cur:
+            await cur.execute("SELECT package FROM users WHERE chat_id=%s", (update.callback_query.from_user.id,))
+            package = (await cur.fetchone())[0]
+    if package == "X":
+        text = f"Access your special Ultra content here: {AI_BOOST_LINK}"
+    else:
+        text = f"Access your content here: {SITE_LINK}"
+    await update.callback_query.edit_message_text(text, reply_markup=BACK_TO_MENU_KB)
+
+async def help_topic_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    content = HELP_TOPICS[data]["text"]
+    await update.callback_query.edit_message_text(content, reply_markup=BACK_TO_HELP_KB)
+
+async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+    await help_menu(update, context)
+
+CALLBACK_HANDLERS = {
+    "menu": menu_callback,
+    "package_selector": package_selector_callback,
+    "reg_standard": register_package_callback,
+    "reg_x": register_package_callback,
+    "show_account_selection": show_account_selection_callback,
+    "access_content": access_content_callback,
+    "help": help_callback,
+    **{key: help_topic_callback for key in HELP_TOPICS},
+}
+PREFIX_CALLBACK_HANDLERS = {
+    "reg_account": reg_account_callback,
+    "approve_reg": approve_reg_callback,
+    "finalize_reg": finalize_reg_callback,
+    "pending_reg": pending_reg_callback,
+}
+# Prefixed actions whose argument is a user's chat_id
+CHAT_ID_ACTIONS = {"approve_reg", "finalize_reg", "pending_reg"}
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
@@ -186,103 +430,23 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     log_interaction(chat_id, f"button_{data}")
 
     try:
-        if data == "menu":
-            if chat_id in user_state:
-                del user_state[chat_id]
-            await show_main_menu(update, context)
-        elif data == "package_selector":
-            status = get_status(chat_id)
-            if status == 'registered':
-                await context.bot.send_message(chat_id, "You are already registered.")
-                return
-            keyboard = [
-                [InlineKeyboardButton("🚀Miamor Ultra (₦14,000)", callback_data="reg_x")],
-                [InlineKeyboardButton("✈️Miamor Plus (₦10,000)", callback_data="reg_standard")],
-                [InlineKeyboardButton("🔙 Main Menu", callback_data="menu")],
-            ]
-            await query.edit_message_text("Choose your package:", reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data in ["reg_standard", "reg_x"]:
-            package = "Standard" if data == "reg_standard" else "X"
-            user_state[chat_id] = {'package': package}
-            try:
-                cursor.execute("UPDATE users SET package=%s, payment_status='pending_payment' WHERE chat_id=%s", (package, chat_id))
-                if cursor.rowcount == 0:
-                    cursor.execute("INSERT INTO users (chat_id, package, payment_status, username) VALUES (%s, %s, 'pending_payment', %s)", (chat_id, package, update.effective_user.username or "Unknown"))
-                conn.commit()
-                keyboard = [[InlineKeyboardButton(a, callback_data=f"reg_account_{a}")] for a in PAYMENT_ACCOUNTS.keys()]
-                keyboard.append([InlineKeyboardButton("🔙 Main Menu", callback_data="menu")])
-                await query.edit_message_text("Select an account to pay to:\n\n:::Note:::\n If you are prompted by your Opay bank app to double check or cancel your transaction with any selected accoount amongst these, please ignore and continue as this is happening as a result of multiple engagement with the accounts\n Proceed with an option below:", reply_markup=InlineKeyboardMarkup(keyboard))
-            except psycopg.Error as e:
-                logger.error(f"Database error in package_selector: {e}")
-                await query.edit_message_text("An error occurred. Please try again.")
-                return
-        elif data.startswith("reg_account_"):
-            account = data[len("reg_account_"):]
-            payment_details = PAYMENT_ACCOUNTS.get(account)
-            if not payment_details:
-                await context.bot.send_message(chat_id, "Error: Invalid account. Contact admin.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]]))
-                return
-            user_state[chat_id]['selected_account'] = account
-            user_state[chat_id]['expecting'] = 'reg_screenshot'
-            keyboard = [
-                [InlineKeyboardButton("Change Account", callback_data="show_account_selection")],
-                [InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]
-            ]
-            await context.bot.send_message(
-                chat_id,
-                f"Payment details:\n\n{payment_details}\n\nPlease make the payment and send the screenshot.",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        elif data == "show_account_selection":
-            package = user_state[chat_id].get('package', '')
-            if not package:
-                await query.edit_message_text("Please select a package first.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]]))
-                return
-            keyboard = [[InlineKeyboardButton(a, callback_data=f"reg_account_{a}")] for a in PAYMENT_ACCOUNTS.keys()]
-            keyboard.append([InlineKeyboardButton("🔙 Main Menu", callback_data="menu")])
-            await query.edit_message_text("Select an account to pay to:\n\n:::Note:::\n If you are prompted by your Opay bank app to double check or cancel your transaction with any selected accoount amongst these, please ignore and continue as this is happening as a result of multiple engagement with the accounts\n Proceed with an option below:", reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data.startswith("approve_reg_"):
-            user_chat_id = int(data.split("_")[2])
-            try:
-                cursor.execute("UPDATE users SET payment_status='pending_details', approved_at=%s WHERE chat_id=%s", (datetime.datetime.now(), user_chat_id))
-                conn.commit()
-                await context.bot.send_message(
-                    user_chat_id,
-                    "✅ Your payment is approved!\n\nPlease send your details:\n➡️ Email address\n➡️ Full name\n➡️ Username (e.g. @you)\n➡️ Phone number (with country code)\n\nAll in one message, each on its own line."
-                )
-                await query.edit_message_text("Payment approved. Waiting for user details.")
-            except psycopg.Error as e:
-                logger.error(f"Database error in approve_reg: {e}")
-                await query.edit_message_text("An error occurred. Please try again.")
-        elif data.startswith("finalize_reg_"):
-            user_chat_id = int(data.split("_")[2])
-            user_state[ADMIN_ID] = {'expecting': 'user_credentials', 'for_user': user_chat_id}
-            await context.bot.send_message(
-                ADMIN_ID,
-                f"Please send the username and password for user {user_chat_id} in the format:\nusername\npassword"
-            )
-            await query.edit_message_text("Waiting for user credentials.")
-        elif data.startswith("pending_reg_"):
-            user_chat_id = int(data.split("_")[2])
-            await context.bot.send_message(user_chat_id, "Your payment is still being reviewed. Please check back later.")
-        elif data == "access_content":
-            cursor.execute("SELECT package FROM users WHERE chat_id=%s", (chat_id,))
-            package = cursor.fetchone()[0]
-            if package == "X":
-                text = f"Access your special Ultra content here: {AI_BOOST_LINK}"
-            else:
-                text = f"Access your content here: {SITE_LINK}"
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]]))
-        elif data in HELP_TOPICS:
-            topic = HELP_TOPICS[data]
-            keyboard = [[InlineKeyboardButton("🔙 Help Menu", callback_data="help")]]
-            content = topic["text"]
-            await query.edit_message_text(content, reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data == "help":
-            await help_menu(update, context)
-        else:
+        handler = CALLBACK_HANDLERS.get(data)
+        arg = data
+        if handler is None:
+            # "<action>_<argument>"; chat_ids and account names contain no underscores
+            action, _, arg = data.rpartition("_")
+            handler = PREFIX_CALLBACK_HANDLERS.get(action)
+            if action in CHAT_ID_ACTIONS:
+                # Malformed targets are treated as unknown actions
+                if re.fullmatch(r"-?[0-9]+", arg):
+                    arg = int(arg)
+                else:
+                    handler = None
+        if handler is None:
             logger.warning(f"Unknown callback data: {data}")
             await query.edit_message_text("Unknown action. Please try again or contact admin.")
+            return
+        await handler(update, context, arg)
     except Exception as e:
         logger.error(f"Error in button_handler: {e}")
         await query.edit_message_text("An error occurred. Please try again or contact admin.")
@@ -290,20 +454,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Message handlers
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    if 'expecting' not in user_state.get(chat_id, {}):
+    state = await state_store.get(chat_id)
+    if 'expecting' not in state:
+        # State expires after StateStore's TTL; don't drop a late screenshot silently
+        if await get_status(chat_id) == 'pending_payment':
+            await update.message.reply_text(
+                "⌛️ Your payment session expired. Please choose your package and payment account again, then resend the screenshot.",
+                reply_markup=PACKAGE_SELECTOR_KB
+            )
         return
-    expecting = user_state[chat_id]['expecting']
+    expecting = state['expecting']
     photo_file = update.message.photo[-1].file_id
     try:
         if expecting == 'reg_screenshot':
-            cursor.execute("INSERT INTO payments (chat_id, package, payment_account) VALUES (%s, %s, %s) RETURNING id",
-                           (chat_id, user_state[chat_id]['package'], user_state[chat_id]['selected_account']))
-            payment_id = cursor.fetchone()[0]
-            conn.commit()
             keyboard = [
                 [InlineKeyboardButton("Approve", callback_data=f"approve_reg_{chat_id}")],
                 [InlineKeyboardButton("Pending", callback_data=f"pending_reg_{chat_id}")],
             ]
+            # Record the payment before the admin gets an Approve button for it
+            await record_payment(chat_id, state['package'], state['selected_account'])
             await context.bot.send_photo(
                 ADMIN_ID,
                 photo_file,
@@ -311,7 +480,8 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             await update.message.reply_text("✅ Screenshot received! Awaiting admin approval.")
-            del user_state[chat_id]['expecting']
+            del state['expecting']
+            await state_store.set(chat_id, state)
         log_interaction(chat_id, "photo_upload")
     except Exception as e:
         logger.error(f"Error in handle_photo: {e}")
@@ -321,8 +491,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     text = update.message.text
     log_interaction(chat_id, "text_message")
-    if 'expecting' in user_state.get(chat_id, {}):
-        expecting = user_state[chat_id]['expecting']
+    state = await state_store.get(chat_id)
+    if 'expecting' in state:
+        expecting = state['expecting']
         try:
             if expecting == 'user_credentials' and chat_id == ADMIN_ID:
                 lines = text.splitlines()
@@ -330,23 +501,27 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text("Please send username and password in two lines.")
                     return
                 username, password = lines
-                for_user = user_state[chat_id]['for_user']
-                cursor.execute(
-                    "UPDATE users SET username=%s, payment_status='registered', registration_date=%s WHERE chat_id=%s",
-                    (username, datetime.datetime.now(), for_user)
-                )
-                conn.commit()
+                for_user = state['for_user']
+                async with pool.connection() as aconn:
+                    await aconn.execute(
+                        "UPDATE users SET username=%s, payment_status='registered', registration_date=NOW() WHERE chat_id=%s",
+                        (username, for_user)
+                    )
                 await context.bot.send_message(
                     for_user,
                     f"🎉 Registration successful! Your username is {username} and password is {password}.\n\nAccess the site: {SITE_LINK}"
                 )
                 await update.message.reply_text("Credentials set and sent to the user.")
-                del user_state[chat_id]
+                await state_store.pop(chat_id)
         except Exception as e:
             logger.error(f"Error in handle_text: {e}")
             await update.message.reply_text("An error occurred. Please try again or contact admin.")
+    elif chat_id == ADMIN_ID:
+        await update.message.reply_text(
+            "No registration is awaiting credentials (it may have expired). Click Finalize Registration again, then resend the username and password."
+        )
     else:
-        status = get_status(chat_id)
+        status = await get_status(chat_id)
         if status == 'pending_details':
             lines = [l.strip() for l in text.splitlines() if l.strip()]
             if len(lines) < 4:
@@ -360,13 +535,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❗️ Username must start with @.")
                 return
             try:
-                cursor.execute(
-                    "UPDATE users SET email=%s, name=%s, username=%s, phone=%s WHERE chat_id=%s",
-                    (email, full_name, username, phone, chat_id)
-                )
-                conn.commit()
-                cursor.execute("SELECT package FROM users WHERE chat_id=%s", (chat_id,))
-                pkg = cursor.fetchone()[0]
+                async with pool.connection() as aconn:
+                    async with aconn.cursor() as cur:
+                        await cur.execute(
+                            "UPDATE users SET email=%s, name=%s, username=%s, phone=%s WHERE chat_id=%s RETURNING package",
+                            (email, full_name, username, phone, chat_id)
+                        )
+                        pkg = (await cur.fetchone())[0]
                 keyboard = [[InlineKeyboardButton("Finalize Registration", callback_data=f"finalize_reg_{chat_id}")]]
                 await context.bot.send_message(
                     ADMIN_ID,
@@ -375,7 +550,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 await update.message.reply_text(
                     "✅ Details received! Awaiting admin finalization.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Main Menu", callback_data="menu")]])
+                    reply_markup=BACK_TO_MENU_KB
                 )
             except psycopg.Error as e:
                 logger.error(f"Database error in pending_details: {e}")
@@ -385,22 +560,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        cursor.execute("SELECT payment_status, package FROM users WHERE chat_id=%s", (chat_id,))
-        user = cursor.fetchone()
-        keyboard = [
-            [InlineKeyboardButton("💸 I'm Interested", callback_data="package_selector")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")],
-        ]
-        if user and user[0] == 'registered':
-            keyboard = [
-                [InlineKeyboardButton("📂 Access Content", callback_data="access_content")],
-                [InlineKeyboardButton("❓ Help", callback_data="help")],
-            ]
+        async with pool.connection() as aconn:
+            async with aconn.cursor() as cur:
+                await cur.execute("SELECT payment_status, package FROM users WHERE chat_id=%s", (chat_id,))
+                user = await cur.fetchone()
+        keyboard = REGISTERED_MENU_KB if user and user[0] == 'registered' else MAIN_MENU_KB
         text = "🥰❤️💕LOVE is sweet o, when money enter love is sweeter... Mi'amor offers two dynamic packages to fuel your earning potential\n\n1. 𝚃𝚑𝚎 𝚙𝚕𝚞𝚜 𝚙𝚊𝚌𝚔𝚊𝚐𝚎\n2. 𝚃𝚑𝚎 𝚄𝚕𝚝𝚛𝚊 𝚙𝚊𝚌𝚔𝚊𝚐𝚎\n\nMIAMOR PLUS✨\n💰Access Fee/Signup Fee: N10,000\n💰 Onboarding Gift🎁: N8,000\n💰Connection Commission/REF: N9,100\n💰1st Level Spillover: N200\n💰2nd Level Spillover: N100\n💰Game modules: N2,000 daily\n💰Matching ads-on: N2,000 daily\n💰Open love hamper: N5,000 on every love box opened\n💰Tiktok/fb lovers share: N1,500 per 5,000 views.\n\nMIAMOR ULTRA\n💰Access Fee/Signup Fee: N14,000\n💰 Onboarding Gift🎁: N12,500\n💰Connection Commission/REF: N12,500\n💰1st Level Spillover: N400\n💰2nd Level Spillover: N150\n💰Game modules: N5,000 daily\n💰Matching ads-on: N3,000 daily\n💰Open love hamper: N10,000 on every love hamper/box opened\n💰Tiktok/fb lovers share: N2,500 per 5,000 views.\n\n Click the button below if you're READY to get started"
         if update.callback_query:
-            await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await update.callback_query.edit_message_text(text, reply_markup=keyboard)
         else:
-            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await update.message.reply_text(text, reply_markup=keyboard)
         log_interaction(chat_id, "show_main_menu")
     except psycopg.Error as e:
         logger.error(f"Database error in show_main_menu: {e}")
@@ -408,17 +577,79 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.callback_query.from_user.id
-    keyboard = [[InlineKeyboardButton(topic["label"], callback_data=key)] for key, topic in HELP_TOPICS.items()]
-    keyboard.append([InlineKeyboardButton("🔙 Main Menu", callback_data="menu")])
     query = update.callback_query
-    await query.edit_message_text("What would you like help with?", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.edit_message_text("What would you like help with?", reply_markup=HELP_KB)
     log_interaction(chat_id, "help_menu")
 
+async def expire_user_state(context: ContextTypes.DEFAULT_TYPE):
+    state_store.expire()
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, but updates from
+    the same chat one at a time, so StateStore read-modify-writes for a chat
+    (e.g. an album of screenshots, or a menu click mid-upload) never interleave."""
+
+    def __init__(self, max_concurrent_updates=256):
+        super().__init__(max_concurrent_updates)
+        # Locks drop out once no update for the chat holds or awaits them
+        self.chat_locks = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        lock = self.chat_locks.get(chat.id)
+        if lock is None:
+            lock = self.chat_locks[chat.id] = asyncio.Lock()
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class AdminRateLimiter(AIORateLimiter):
+    """AIORateLimiter only applies per-chat limits to groups and channels, so
+    also hold requests to the admin's private chat to one per second."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.admin_limiter = AsyncLimiter(1, 1)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if str(data.get("chat_id")) == str(ADMIN_ID):
+            async with self.admin_limiter:
+                return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+        return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+async def post_init(application: Application):
+    await pool.open()
+    await init_db()
+    # In webhook mode Telegram's own requests keep the dyno awake and PTB owns PORT
+    if not PUBLIC_URL:
+        await keep_alive()
+
+async def post_shutdown(application: Application):
+    if not PUBLIC_URL:
+        await web_runner.cleanup()
+    await pool.close()
+    await state_store.close()
+
 # Main
 def main():
-    keep_alive()
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(PerChatUpdateProcessor())
+            .rate_limiter(AdminRateLimiter(overall_max_rate=29, overall_time_period=1, max_retries=3))
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
         # Add handlers
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("menu", show_main_menu))
@@ -426,13 +657,25 @@ def main():
         application.add_handler(CallbackQueryHandler(button_handler))
         application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+        # Drop abandoned flows even when nobody touches the cache
+        application.job_queue.run_repeating(expire_user_state, interval=300)
         # Log that the bot is running
         logger.info("Bot is up and running...")
-        # Start polling
-        application.run_polling()
+        if PUBLIC_URL:
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=BOT_TOKEN,
+                webhook_url=f"{PUBLIC_URL}/{BOT_TOKEN}",
+            )
+        else:
+            application.run_polling()
     except Exception as e:
         logger.error(f"Error in main: {e}")
         print("Failed to start bot. Check logs for details.")
+    finally:
+        # Flush queued records, including any logged during shutdown
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
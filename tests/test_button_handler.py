@@ -0,0 +1,35 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import main
+
+
+def make_update(data):
+    query = MagicMock()
+    query.data = data
+    query.from_user.id = main.ADMIN_ID
+    query.answer = AsyncMock()
+    query.edit_message_text = AsyncMock()
+    update = MagicMock()
+    update.callback_query = query
+    return update
+
+
+@pytest.mark.parametrize("data", ["approve_reg_--5", "approve_reg_²", "finalize_reg_12a", "pending_reg_"])
+def test_malformed_chat_id_is_unknown_action(data):
+    update = make_update(data)
+    asyncio.run(main.button_handler(update, MagicMock()))
+    update.callback_query.edit_message_text.assert_awaited_once_with(
+        "Unknown action. Please try again or contact admin."
+    )
+
+
+@pytest.mark.parametrize("data, expected", [("pending_reg_42", 42), ("pending_reg_-100123", -100123)])
+def test_chat_id_actions_receive_int(data, expected):
+    update = make_update(data)
+    context = MagicMock()
+    context.bot.send_message = AsyncMock()
+    asyncio.run(main.button_handler(update, context))
+    assert context.bot.send_message.await_args.args[0] == expected
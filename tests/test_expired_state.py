@@ -0,0 +1,37 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import main
+
+
+def make_message_update(chat_id):
+    update = MagicMock()
+    update.message.chat_id = chat_id
+    update.message.text = "someone\nsecret"
+    update.message.reply_text = AsyncMock()
+    return update
+
+
+def test_late_screenshot_prompts_to_restart(monkeypatch):
+    monkeypatch.setattr(main, "get_status", AsyncMock(return_value="pending_payment"))
+    update = make_message_update(4242)
+    asyncio.run(main.handle_photo(update, MagicMock()))
+    update.message.reply_text.assert_awaited_once()
+    assert "expired" in update.message.reply_text.await_args.args[0]
+
+
+def test_unrelated_photo_is_ignored(monkeypatch):
+    monkeypatch.setattr(main, "get_status", AsyncMock(return_value="registered"))
+    update = make_message_update(4243)
+    asyncio.run(main.handle_photo(update, MagicMock()))
+    update.message.reply_text.assert_not_awaited()
+
+
+def test_late_admin_credentials_prompt_to_finalize_again(monkeypatch):
+    get_status = AsyncMock()
+    monkeypatch.setattr(main, "get_status", get_status)
+    update = make_message_update(main.ADMIN_ID)
+    asyncio.run(main.handle_text(update, MagicMock()))
+    update.message.reply_text.assert_awaited_once()
+    assert "Finalize Registration again" in update.message.reply_text.await_args.args[0]
+    get_status.assert_not_awaited()
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import time
+
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+import main
+
+
+class FakeRequest(BaseRequest):
+    """Answers Bot API calls locally so requests go through ExtBot's real
+    rate limiter path without touching the network."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Miamo", "username": "miamo_bot"}
+        else:
+            chat_id = int(request_data.parameters["chat_id"])
+            result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "ok"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_bot():
+    limiter = main.AdminRateLimiter(overall_max_rate=29, overall_time_period=1, max_retries=3)
+    return ExtBot(main.BOT_TOKEN, request=FakeRequest(), get_updates_request=FakeRequest(), rate_limiter=limiter)
+
+
+def test_initialize_goes_through_limiter():
+    async def run():
+        bot = make_bot()
+        await bot.initialize()
+        assert bot.username == "miamo_bot"
+        await bot.shutdown()
+
+    asyncio.run(run())
+
+
+def test_admin_chat_limited_to_one_per_second():
+    async def run():
+        bot = make_bot()
+        await bot.initialize()
+        start = time.monotonic()
+        await bot.send_message(main.ADMIN_ID, "first")
+        await bot.send_message(main.ADMIN_ID, "second")
+        elapsed = time.monotonic() - start
+        await bot.shutdown()
+        return elapsed
+
+    assert asyncio.run(run()) >= 0.9
+
+
+def test_other_chats_not_admin_limited():
+    async def run():
+        bot = make_bot()
+        await bot.initialize()
+        start = time.monotonic()
+        await bot.send_message(main.ADMIN_ID + 1, "first")
+        await bot.send_message(main.ADMIN_ID + 1, "second")
+        elapsed = time.monotonic() - start
+        await bot.shutdown()
+        return elapsed
+
+    assert asyncio.run(run()) < 0.5